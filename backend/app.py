@@ -5,6 +5,12 @@ import threading
 
 app = FastAPI()
 
+# --- Simulation State ---
+# Only one SUMO instance may run at a time; repeated requests report on it instead of starting another
+_sim_lock = threading.Lock()
+_sim_state = {"thread": None, "manager": None}
+STOP_TIMEOUT = 10  # Seconds a forced restart waits for the old run to stop (a paused sumo-gui never does)
+
 # --- CORS Middleware ---
 app.add_middleware(
     CORSMiddleware,
@@ -19,19 +25,31 @@ def read_root():
     return {"status": "Backend is running!"}
 
 @app.post("/run-simulation")
-def run_simulation_endpoint():
+def run_simulation_endpoint(force: bool = False):
     """
     API endpoint to start the SUMO simulation in a background thread.
+    If one is already running it is left alone, unless force=true asks to restart it.
     """
     try:
-        # Configure and create the simulation manager
-        # Ensure this path is correct relative to where you run uvicorn
-        sumo_config_file = "../sumo_files/f1.sumocfg"
-        sim_manager = SimulationManager(sumo_config_file, use_gui=True)
-        
-        # Run the simulation in a separate thread so the API doesn't block
-        simulation_thread = threading.Thread(target=sim_manager.run)
-        simulation_thread.start()
+        with _sim_lock:
+            running_thread = _sim_state["thread"]
+            if running_thread and running_thread.is_alive():
+                if not force:
+                    return {"message": "Simulation is already running."}
+                _sim_state["manager"].stop()
+                running_thread.join(timeout=STOP_TIMEOUT)
+                if running_thread.is_alive():
+                    return {"error": f"The running simulation did not stop within {STOP_TIMEOUT} s; is sumo-gui paused?"}
+
+            # Configure and create the simulation manager
+            # Ensure this path is correct relative to where you run uvicorn
+            sumo_config_file = "../sumo_files/f1.sumocfg"
+            sim_manager = SimulationManager(sumo_config_file, use_gui=True)
+            
+            # Run the simulation in a separate thread so the API doesn't block
+            simulation_thread = threading.Thread(target=sim_manager.run)
+            simulation_thread.start()
+            _sim_state["thread"], _sim_state["manager"] = simulation_thread, sim_manager
         
         return {"message": "Simulation started successfully in the background."}
     except Exception as e:
@@ -1,54 +1,106 @@
-import xml.etree.ElementTree as ET
+import os
+import re
+from collections import defaultdict
 from typing import Dict, List, Any
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+_COORD_SEP = re.compile(r'[ ,]+')
+NETWORK_CACHE_VERSION = 1  # Bump whenever parse_network's output changes shape
+
+def _parse_shape(shape_str: str) -> List[Dict[str, float]]:
+    # One C-level parse per shape; points may carry a z coordinate, which is dropped
+    points = shape_str.split()
+    if np is None:
+        values = list(map(float, _COORD_SEP.split(' '.join(points))))
+        dims = len(values) // len(points)
+        return [{"x": values[i], "y": values[i + 1]} for i in range(0, len(values), dims)]
+    coords = np.fromstring(','.join(points), sep=',').reshape(len(points), -1)
+    return [{"x": x, "y": y} for x, y in coords[:, :2].tolist()]
+
 def parse_network(net_file_path: str) -> Dict[str, Any]:
     """
     Parses a SUMO .net.xml file to extract detailed information about edges (roads),
     lanes, and traffic light signal connections for accurate frontend rendering.
+    The file is streamed in a single pass; each top-level element is cleared once handled.
     """
-    tree = ET.parse(net_file_path)
-    root = tree.getroot()
-    
     network_data: Dict[str, Any] = {"edges": [], "lanes": [], "tls": {}}
+    tls_ids: List[str] = []
+    conns_by_tl: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+
+    for _, elem in ET.iterparse(net_file_path, events=("end",)):
+        if elem.tag == "edge":
+            lanes_on_edge = elem.findall("lane")
 
-    # Extract edges that are actual roads (not internal junction links)
-    for edge in root.findall("edge"):
-        if not edge.get("function") == "internal":
-            lanes_on_edge = edge.findall("lane")
-            if lanes_on_edge:
-                shape_str = lanes_on_edge[0].get("shape")
-                shape_points = [
-                    {"x": float(p.split(',')[0]), "y": float(p.split(',')[1])}
-                    for p in shape_str.split(' ') if ',' in p
-                ]
+            # Extract edges that are actual roads (not internal junction links)
+            if lanes_on_edge and not elem.get("function") == "internal":
                 network_data["edges"].append({
-                    "id": edge.get("id"),
-                    "shape": shape_points,
+                    "id": elem.get("id"),
+                    "shape": _parse_shape(lanes_on_edge[0].get("shape")),
                     "width": float(lanes_on_edge[0].get("width", 3.2)),
                     "lanes": len(lanes_on_edge)
                 })
 
-    # Extract all individual lane shapes for potential detailed drawing
-    for lane in root.findall(".//lane"):
-        shape_str = lane.get("shape")
-        if shape_str:
-            shape_points = [
-                {"x": float(p.split(',')[0]), "y": float(p.split(',')[1])}
-                for p in shape_str.split(' ') if ',' in p
-            ]
-            network_data["lanes"].append({ "id": lane.get("id"), "shape": shape_points })
+            # Extract all individual lane shapes for potential detailed drawing
+            for lane in lanes_on_edge:
+                shape_str = lane.get("shape")
+                if shape_str:
+                    network_data["lanes"].append({"id": lane.get("id"), "shape": _parse_shape(shape_str)})
+        elif elem.tag == "tlLogic":
+            tls_ids.append(elem.get("id"))
+        elif elem.tag == "connection":
+            tl = elem.get("tl")
+            if tl is not None:
+                conns_by_tl[tl].append({
+                    "from": elem.get("from"),
+                    "to": elem.get("to"),
+                    "via": elem.get("via"),
+                    "linkIndex": int(elem.get("linkIndex"))
+                })
+        else:
+            continue
+        elem.clear()
 
     # Extract traffic light connection details
-    for tls in root.findall("tlLogic"):
-        tls_id = tls.get("id")
-        links = []
-        for conn in root.findall(f"connection[@tl='{tls_id}']"):
-            links.append({
-                "from": conn.get("from"),
-                "to": conn.get("to"),
-                "via": conn.get("via"),
-                "linkIndex": int(conn.get("linkIndex"))
-            })
-        network_data["tls"][tls_id] = {"links": sorted(links, key=lambda x: x['linkIndex'])}
-
-    return network_data
\ No newline at end of file
+    for tls_id in tls_ids:
+        network_data["tls"][tls_id] = {"links": sorted(conns_by_tl[tls_id], key=lambda x: x['linkIndex'])}
+
+    return network_data
+
+def load_network(net_file_path: str) -> Dict[str, Any]:
+    """
+    Returns parse_network's result, cached as msgpack next to the network file.
+    The cache is reused as long as it is not older than the .net.xml it came from
+    and was written for the current NETWORK_CACHE_VERSION.
+    """
+    if msgpack is None:
+        return parse_network(net_file_path)
+
+    cache_path = os.path.splitext(net_file_path)[0] + ".msgpack"
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(net_file_path):
+        with open(cache_path, "rb") as f:
+            cached = msgpack.unpackb(f.read())
+        if isinstance(cached, dict) and cached.get("v") == NETWORK_CACHE_VERSION:
+            return cached["data"]
+
+    network_data = parse_network(net_file_path)
+    try:
+        with open(cache_path + ".tmp", "wb") as f:
+            f.write(msgpack.packb({"v": NETWORK_CACHE_VERSION, "data": network_data}))
+        os.replace(cache_path + ".tmp", cache_path)
+    except OSError:
+        pass  # A read-only checkout just parses on every start
+    return network_data
@@ -0,0 +1,36 @@
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+def _argmax_pressure(waits, phase_lane_ids, phase_offsets):
+    """
+    Sums the waiting times of each phase's lanes and returns (best_phase, max_pressure).
+    Phase p owns waits[phase_lane_ids[phase_offsets[p]:phase_offsets[p + 1]]]; ties go to the first phase.
+    """
+    best_phase, max_pressure = -1, -1.0
+    for p in range(phase_offsets.shape[0] - 1):
+        pressure = 0.0
+        for k in range(phase_offsets[p], phase_offsets[p + 1]):
+            pressure += waits[phase_lane_ids[k]]
+        if pressure > max_pressure:
+            best_phase, max_pressure = p, pressure
+    return best_phase, max_pressure
+
+def _argmax_pressure_numpy(waits, phase_lane_ids, phase_offsets):
+    """Same reduction as _argmax_pressure, vectorised for when numba is not installed."""
+    if phase_offsets.shape[0] < 2:
+        return -1, -1.0
+    pressures = np.add.reduceat(waits[phase_lane_ids], phase_offsets[:-1])
+    best_phase = int(pressures.argmax())
+    return best_phase, float(pressures[best_phase])
+
+if njit is not None:
+    # An explicit signature compiles at import, so the first control step doesn't pay for it.
+    # Waiting times are finite and non-negative, so fastmath's reassociation of the sums is safe
+    argmax_pressure = njit("Tuple((int32, float64))(float64[:], int32[:], int32[:])",
+                           cache=True, fastmath=True, boundscheck=False)(_argmax_pressure)
+else:
+    argmax_pressure = _argmax_pressure_numpy
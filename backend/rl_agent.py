@@ -1,62 +1,172 @@
 # Correct code for rl_agent.py
 
-import random
+import json
 import numpy as np
-import pickle
 import os
+import pickle
+import random
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+Q_ROW_CHUNK = 1024  # Rows added to the Q-matrix each time it runs out of space
+
+if njit is not None:
+    @njit(cache=True, fastmath=True)
+    def _update(row, a, reward, next_row, alpha, gamma):
+        row[a] += alpha * (reward + gamma * next_row.max() - row[a])
+
+    @njit(cache=True)
+    def _choose(row, epsilon):
+        n_actions = row.shape[0]
+        if np.random.random() < epsilon:
+            return np.random.randint(n_actions)
+        max_q = row.max()
+        ties = 0
+        for i in range(n_actions):
+            ties += row[i] == max_q
+        # Pick the k-th best action so ties are broken uniformly at random
+        k = np.random.randint(ties)
+        for i in range(n_actions):
+            if row[i] == max_q:
+                if k == 0:
+                    return i
+                k -= 1
+        return n_actions - 1
+else:
+    # Interpreted, the loops above would touch one NumPy scalar at a time, which is slower than
+    # the old dict agent; converting the (short) row to floats once keeps it on par
+    def _update(row, a, reward, next_row, alpha, gamma):
+        q = row.item(a)
+        row[a] = q + alpha * (reward + gamma * max(next_row.tolist()) - q)
+
+    def _choose(row, epsilon):
+        if random.random() < epsilon:
+            return random.randrange(len(row))
+        q_values = row.tolist()
+        max_q = max(q_values)
+        return random.choice([i for i, q in enumerate(q_values) if q == max_q])
+
+def _as_state(value):
+    """JSON turns state tuples into lists; turn them back so they hash again."""
+    return tuple(_as_state(v) for v in value) if isinstance(value, list) else value
 
 class QLearningAgent:
     def __init__(self, actions, learning_rate=0.1, discount_factor=0.9, epsilon=0.1):
         self.actions = actions
+        self.action_index = {a: i for i, a in enumerate(actions)}
         self.alpha = learning_rate
         self.gamma = discount_factor
         self.epsilon = epsilon
-        self.q_table = {}
-        self.q_table_path = 'q_table.pkl'
+        # Dense Q-matrix: one row per seen state, one column per action
+        self.q = np.zeros((0, len(actions)))
+        self.state_id = {}
+        self.row_views = {}  # state -> view of its row in self.q
+        self.q_table_path = 'q_table.npy'
+        self.states_path = 'q_table_states.json'
+        self.legacy_q_table_path = 'q_table.pkl'  # {(state, action): value} dict from before the matrix
         self.load_q_table()
+        # Compile the kernels now so the first real decision doesn't pay for it
+        warm_q = np.zeros((2, len(actions)))
+        _choose(warm_q[0], 0.0)
+        _update(warm_q[0], 0, 0.0, warm_q[1], self.alpha, self.gamma)
+
+    def _row(self, state):
+        """Return the Q-matrix row of a state, allocating a zeroed row for unseen states."""
+        row = self.state_id.get(state)
+        if row is None:
+            row = len(self.state_id)
+            if row == len(self.q):
+                self.q = np.vstack([self.q, np.zeros((Q_ROW_CHUNK, len(self.actions)))])
+                self.row_views.clear()  # Views into the old matrix are stale now
+            self.state_id[state] = row
+        return row
+
+    def _q_row(self, state):
+        """Return a zero-copy view of a state's Q-values, cached until self.q is reallocated."""
+        view = self.row_views.get(state)
+        if view is None:
+            row = self._row(state)  # May grow self.q, so resolve it before indexing
+            view = self.row_views[state] = self.q[row]
+        return view
 
     def get_q_value(self, state, action):
         """Retrieve the Q-value from the table, defaulting to 0."""
-        return self.q_table.get((state, action), 0.0)
+        row, col = self.state_id.get(state), self.action_index.get(action)
+        return 0.0 if row is None or col is None else float(self.q[row, col])
 
     def choose_action(self, state):
         """
         Choose an action using an epsilon-greedy strategy.
         """
-        if random.uniform(0, 1) < self.epsilon:
-            return random.choice(self.actions)
-        else:
-            q_values = [self.get_q_value(state, a) for a in self.actions]
-            max_q = max(q_values)
-            best_actions_indices = [i for i, q in enumerate(q_values) if q == max_q]
-            chosen_action_index = random.choice(best_actions_indices)
-            return self.actions[chosen_action_index]
+        return self.actions[_choose(self._q_row(state), self.epsilon)]
 
     def update(self, state, action, reward, next_state):
         """
         Update the Q-table using the Bellman equation.
         """
-        old_q = self.get_q_value(state, action)
-        future_q = max([self.get_q_value(next_state, a) for a in self.actions])
-        new_q = old_q + self.alpha * (reward + self.gamma * future_q - old_q)
-        self.q_table[(state, action)] = new_q
-    
+        self._row(next_state)  # Allocate first, growing self.q after taking a view would orphan it
+        q_values, next_q_values = self._q_row(state), self._q_row(next_state)
+        _update(q_values, self.action_index[action], float(reward), next_q_values, self.alpha, self.gamma)
+
     def load_q_table(self):
         """Loads the Q-table from a file if it exists."""
-        if os.path.exists(self.q_table_path):
-            with open(self.q_table_path, 'rb') as f:
-                self.q_table = pickle.load(f)
+        if os.path.exists(self.q_table_path) and os.path.exists(self.states_path):
+            # Copy-on-write mapping: rows are paged in as they are touched and updates stay in memory
+            self.q = np.asarray(np.load(self.q_table_path, mmap_mode='c'))
+            self.row_views.clear()
+            with open(self.states_path, 'r') as f:
+                self.state_id = {_as_state(s): i for i, s in enumerate(json.load(f))}
+            # The state list is swapped in after the matrix; if a save died in between, rows past
+            # the older list belong to states it never recorded and must not be handed to new ones
+            spare = self.q[len(self.state_id):]
+            if spare.any():
+                spare[:] = 0.0
             print("Q-table loaded successfully.")
+        elif os.path.exists(self.legacy_q_table_path):
+            with open(self.legacy_q_table_path, 'rb') as f:
+                legacy = pickle.load(f)
+            for (state, action), value in legacy.items():
+                col = self.action_index.get(action)
+                if col is not None:
+                    row = self._row(state)  # May grow self.q, so resolve it before indexing
+                    self.q[row, col] = value
+            print(f"Imported legacy Q-table from {self.legacy_q_table_path}; it is saved as {self.q_table_path} from now on.")
         else:
             print("No existing Q-table found. Starting fresh.")
 
     def save_q_table(self):
         """Saves the Q-table to a file."""
-        with open(self.q_table_path, 'wb') as f:
-            pickle.dump(self.q_table, f)
+        # Write a new file and swap it in; truncating the one that is mapped would break self.q.
+        # A chunk of zeroed spare rows is saved too, so new states after a reload fill rows of the
+        # mapping instead of forcing _row to vstack (and so copy) the whole matrix into RAM
+        n_rows = len(self.state_id) + Q_ROW_CHUNK
+        q = self.q[:n_rows]
+        if len(q) < n_rows:
+            q = np.vstack([q, np.zeros((n_rows - len(q), len(self.actions)))])
+        tmp_path = self.q_table_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, q)
+        states_tmp_path = self.states_path + '.tmp'
+        with open(states_tmp_path, 'w') as f:
+            json.dump(list(self.state_id), f)
+
+        # Windows refuses to replace a file that is still mapped, so drop the mapping first.
+        # Everything it held has just been written out, so mapping the new file loses nothing
+        mapped = isinstance(self.q.base, np.memmap)
+        if mapped:
+            del q
+            self.q = None
+            self.row_views.clear()
+        os.replace(tmp_path, self.q_table_path)
+        os.replace(states_tmp_path, self.states_path)
+        if mapped:
+            self.q = np.asarray(np.load(self.q_table_path, mmap_mode='c'))
         print(f"Q-table saved to {self.q_table_path}")
 
     def decay_epsilon(self, min_epsilon=0.05, decay_rate=0.9995):
         """Gradually reduce the exploration rate."""
         if self.epsilon > min_epsilon:
-            self.epsilon *= decay_rate
\ No newline at end of file
+            self.epsilon *= decay_rate
@@ -1,17 +1,50 @@
 import traci
+import traci.constants as tc
+import numpy as np
 import os
 import sys
+import threading
+
+from pressure import argmax_pressure
+from traffic_light import discover_traffic_light
+
+try:
+    import libsumo  # In-process SUMO bindings; same API as traci without the TCP round-trips
+except ImportError:
+    libsumo = None
 
 # --- Constants for the State-Machine Algorithm ---
 MIN_GREEN_TIME = 10        # Minimum time a phase must remain green
 YELLOW_PHASE_DURATION = 4  # How long a yellow light should last
 
+class TLSControlListener(traci.StepListener):
+    """Runs every traffic light's state machine as part of each simulation step."""
+    def __init__(self, manager):
+        self.manager = manager
+        self.steps = 0
+
+    def step(self, t=0):
+        for tls_id in self.manager.traffic_lights:
+            self.manager._control_traffic_light_state_machine(tls_id, self.steps)
+        self.steps += 1
+        return True
+
 class SimulationManager:
     def __init__(self, sumo_cfg, use_gui=True, max_steps=5000):
         self.sumo_cfg = sumo_cfg
         self.use_gui = use_gui
         self.max_steps = max_steps
+        # libsumo cannot drive sumo-gui, so the GUI always goes through TraCI
+        self.traci = traci if use_gui or libsumo is None else libsumo
+        # Bound once: these run for every light on every step
+        self._tls_set_phase = self.traci.trafficlight.setPhase
+        self._lane_results = self.traci.lane.getAllSubscriptionResults
         self.traffic_lights = {}
+        self._stop_requested = threading.Event()
+
+    def stop(self):
+        """Asks a running simulation to close SUMO and return after its current step."""
+        self._stop_requested.set()
 
     def run(self):
         """Starts SUMO and runs the main simulation loop with explicit yellow light control."""
@@ -19,17 +52,23 @@ class SimulationManager:
         if not sumo_binary:
             return
         
-        traci.start([sumo_binary, "-c", self.sumo_cfg])
+        self.traci.start([sumo_binary, "-c", self.sumo_cfg])
+        # Delivered with every step's reply, so the loop condition costs no extra round-trip
+        self.traci.simulation.subscribe([tc.VAR_MIN_EXPECTED_VEHICLES])
         self._discover_network_and_phases()
 
+        listener_id = self.traci.addStepListener(TLSControlListener(self))
+
+        # Locals for the per-step calls, so the loop does no attribute lookups
+        sim_results, sim_step, stop_requested = self.traci.simulation.getSubscriptionResults, self.traci.simulationStep, self._stop_requested.is_set
         step = 0
-        while step < self.max_steps and traci.simulation.getMinExpectedNumber() > 0:
-            traci.simulationStep()
-            for tls_id in self.traffic_lights:
-                self._control_traffic_light_state_machine(tls_id, step)
+        while step < self.max_steps and not stop_requested() and sim_results()[tc.VAR_MIN_EXPECTED_VEHICLES] > 0:
+            sim_step()
             step += 1
         
-        traci.close()
+        # close() keeps listeners registered (libsumo's live for the whole process)
+        self.traci.removeStepListener(listener_id)
+        self.traci.close()
         print("Simulation finished.")
 
     def _discover_network_and_phases(self):
@@ -37,42 +76,9 @@ class SimulationManager:
         Discovers traffic lights, maps green phases to lanes, and identifies
         the corresponding yellow phase for each green phase.
         """
-        all_tls_ids = traci.trafficlight.getIDList()
+        all_tls_ids = self.traci.trafficlight.getIDList()
         for tls_id in all_tls_ids:
-            logic = traci.trafficlight.getCompleteRedYellowGreenDefinition(tls_id)[0]
-            
-            phase_to_lanes_map = {}
-            green_phases = []
-            for i, phase in enumerate(logic.phases):
-                state = phase.state.lower()
-                if 'g' in state and 'y' not in state:
-                    green_phases.append(i)
-                    phase_to_lanes_map[i] = set()
-
-            # Find the yellow phase that follows each green phase
-            yellow_phase_map = {}
-            for green_idx in green_phases:
-                # The yellow phase is typically the next one in the sequence
-                next_phase_idx = (green_idx + 1) % len(logic.phases)
-                if 'y' in logic.phases[next_phase_idx].state.lower():
-                    yellow_phase_map[green_idx] = next_phase_idx
-
-            controlled_links = traci.trafficlight.getControlledLinks(tls_id)
-            for link_idx, links in enumerate(controlled_links):
-                for phase_idx in green_phases:
-                    phase_state = logic.phases[phase_idx].state.lower()
-                    if link_idx < len(phase_state) and phase_state[link_idx] == 'g':
-                        for link in links:
-                            phase_to_lanes_map[phase_idx].add(link[0])
-            
-            self.traffic_lights[tls_id] = {
-                'phase_to_lanes': {p: list(l) for p, l in phase_to_lanes_map.items() if l},
-                'yellow_phase_map': yellow_phase_map,
-                'timer': 0,
-                'state': 'GREEN', # Can be 'GREEN' or 'YELLOW'
-                'current_phase_index': traci.trafficlight.getPhase(tls_id),
-                'target_phase': None
-            }
+            self.traffic_lights[tls_id] = discover_traffic_light(self.traci, tls_id)
         print("Discovered and mapped traffic light phases including yellow transitions.")
 
     def _control_traffic_light_state_machine(self, tls_id, step):
@@ -80,50 +86,50 @@ class SimulationManager:
         Controls a traffic light using a state machine ('GREEN' -> 'YELLOW' -> 'GREEN').
         """
         tls_data = self.traffic_lights[tls_id]
-        tls_data['timer'] += 1
+        tls_data.timer += 1
 
         # --- YELLOW STATE ---
-        if tls_data['state'] == 'YELLOW':
-            if tls_data['timer'] >= YELLOW_PHASE_DURATION:
+        if tls_data.state == 'YELLOW':
+            if tls_data.timer >= YELLOW_PHASE_DURATION:
                 # Yellow time is over, switch to the target green phase
-                traci.trafficlight.setPhase(tls_id, tls_data['target_phase'])
-                tls_data['current_phase_index'] = tls_data['target_phase']
-                tls_data['state'] = 'GREEN'
-                tls_data['timer'] = 0
-                print(f"Step {step}: TLS '{tls_id}' transitioning from YELLOW to GREEN phase {tls_data['current_phase_index']}.")
+                self._tls_set_phase(tls_id, tls_data.target_phase)
+                tls_data.phase = tls_data.target_phase
+                tls_data.state = 'GREEN'
+                tls_data.timer = 0
+                print(f"Step {step}: TLS '{tls_id}' transitioning from YELLOW to GREEN phase {tls_data.phase}.")
             return # Do nothing else while yellow
 
         # --- GREEN STATE ---
-        if tls_data['state'] == 'GREEN':
+        if tls_data.state == 'GREEN':
             # Only check for a switch if the minimum green time has passed
-            if tls_data['timer'] < MIN_GREEN_TIME:
+            if tls_data.timer < MIN_GREEN_TIME:
+                return
+
+            if not tls_data.phase_ids:
                 return
 
-            max_pressure = -1
-            best_phase_index = tls_data['current_phase_index']
-            
-            for phase_idx, lanes in tls_data['phase_to_lanes'].items():
-                pressure = sum(traci.lane.getWaitingTime(lane) for lane in lanes)
-                if pressure > max_pressure:
-                    max_pressure = pressure
-                    best_phase_index = phase_idx
+            lanes = tls_data.controlled_lanes
+            results = self._lane_results()
+            waits = np.fromiter((results[lane][tc.VAR_WAITING_TIME] for lane in lanes), dtype=np.float64, count=len(lanes))
+            best, max_pressure = argmax_pressure(waits, tls_data.phase_lane_ids, tls_data.phase_offsets)
+            best_phase_index = tls_data.phase_ids[best]
 
             # If a better phase is found, start the transition to yellow
-            if best_phase_index != tls_data['current_phase_index'] and max_pressure > 0:
-                current_green_phase = tls_data['current_phase_index']
-                if current_green_phase in tls_data['yellow_phase_map']:
-                    yellow_phase = tls_data['yellow_phase_map'][current_green_phase]
-                    traci.trafficlight.setPhase(tls_id, yellow_phase)
+            if best_phase_index != tls_data.phase and max_pressure > 0:
+                current_green_phase = tls_data.phase
+                if current_green_phase in tls_data.yellow_phase_map:
+                    yellow_phase = tls_data.yellow_phase_map[current_green_phase]
+                    self._tls_set_phase(tls_id, yellow_phase)
                     
-                    tls_data['state'] = 'YELLOW'
-                    tls_data['target_phase'] = best_phase_index
-                    tls_data['timer'] = 0
+                    tls_data.state = 'YELLOW'
+                    tls_data.target_phase = best_phase_index
+                    tls_data.timer = 0
                     print(f"Step {step}: TLS '{tls_id}' starting YELLOW transition from phase {current_green_phase} towards {best_phase_index}.")
                 else:
                     # Fallback if no yellow phase is found (should not happen in a well-defined network)
-                    traci.trafficlight.setPhase(tls_id, best_phase_index)
-                    tls_data['current_phase_index'] = best_phase_index
-                    tls_data['timer'] = 0
+                    self._tls_set_phase(tls_id, best_phase_index)
+                    tls_data.phase = best_phase_index
+                    tls_data.timer = 0
 
     def _get_sumo_binary(self):
         """Returns the path to the SUMO executable."""
@@ -1,17 +1,27 @@
 import asyncio
-import json
 import os
 import queue
 import sys
 import threading
-from typing import List, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any
 
+import numpy as np
+import orjson
 import traci
+import traci.constants as tc
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 
-from network_parser import parse_network
+from network_parser import load_network
+from pressure import argmax_pressure
+from traffic_light import discover_traffic_light
+
+try:
+    import libsumo
+except ImportError:
+    libsumo = None
 
 # --- CONFIGURATION ---
 SUMO_CONFIG_FILE = "f1.sumocfg"
@@ -20,29 +30,99 @@ EDGE_TO_DIRECTION_MAP = {"E3": "North", "-E2": "South", "-E0": "East", "E0": "We
 PHASE_MAPS = {"clusterJ10_J14_J15_J16": {0: "East-West Green", 2: "North-South Green"}}
 MIN_GREEN_TIME = 10
 YELLOW_PHASE_DURATION = 4
+VEHICLE_VARS = (tc.VAR_POSITION, tc.VAR_ANGLE, tc.VAR_SPEED)
+CLIENT_QUEUE_SIZE = 8  # Frames buffered per client before its oldest one is dropped
+FRAME_QUEUE_SIZE = 8  # Frames buffered between the simulation thread and the broadcaster
+FINISHED_FRAME = orjson.dumps({"status": "finished"})
+KEYFRAME_INTERVAL = 20  # Steps after which an unchanged frame is sent anyway
+
+# The simulation thread gets the first CPU to itself and the event loop the rest, where threads can be pinned
+_CPUS = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_setaffinity") else []
+SIM_CPUS, LOOP_CPUS = ({_CPUS[0]}, set(_CPUS[1:])) if len(_CPUS) >= 2 else (None, None)
+
+def pin_current_thread(cpus):
+    """Restricts the calling thread to the given CPUs; a no-op where pinning is unavailable."""
+    if cpus: os.sched_setaffinity(0, cpus)
+
+def frame_key(data: Dict[str, Any]) -> int:
+    """Hashes everything a client renders, i.e. the whole frame except its step number."""
+    vehicles = data["vehicles"]
+    return hash((
+        tuple(data["waiting_vehicles"].values()), data["green_direction"], data["control_mode"],
+        tuple(tls["state"] for tls in data["tlsState"].values()), tuple(vehicles["ids"]),
+        vehicles["xy"].tobytes(), vehicles["angle"].tobytes(), vehicles["speed"].tobytes()
+    ))
+
+def put_latest(q: asyncio.Queue, item):
+    """Queues an item, dropping the oldest one when full. Must run on the event loop thread."""
+    if q.full(): q.get_nowait()
+    q.put_nowait(item)
 
 class ConnectionManager:
+    """Each client gets its own bounded queue and writer task, so a slow client never stalls the others."""
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Dict[WebSocket, asyncio.Queue] = {}
+        self.writers: Dict[WebSocket, asyncio.Task] = {}
     async def connect(self, ws: WebSocket):
         await ws.accept()
-        self.active_connections.append(ws)
+        self.active_connections[ws] = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self.writers[ws] = asyncio.create_task(self._write(ws, self.active_connections[ws]))
     def disconnect(self, ws: WebSocket):
-        self.active_connections.remove(ws)
-    async def broadcast(self, msg: str):
-        for conn in self.active_connections:
-            await conn.send_text(msg)
+        self.active_connections.pop(ws, None)
+        writer = self.writers.pop(ws, None)
+        if writer: writer.cancel()
+    async def _write(self, ws: WebSocket, q: asyncio.Queue):
+        # Deliberately through send_bytes rather than the raw transport: the ASGI server owns framing,
+        # flow control and close handling, and the payload is already encoded once for all clients
+        try:
+            while True: await ws.send_bytes(await q.get())
+        except Exception:
+            self.disconnect(ws)
+    def broadcast(self, msg: bytes):
+        # Synchronous fan-out: the same encoded frame is handed to every writer without awaiting any of them
+        # Iterate a snapshot so a disconnect can never change the dict underneath the loop
+        for q in tuple(self.active_connections.values()):
+            put_latest(q, msg)  # Only the latest state matters to a client that fell behind
 
 # --- SIMULATION MANAGER ---
+class TLSControlListener(traci.StepListener):
+    """Runs the per-step bookkeeping and traffic light control as part of each simulation step."""
+    def __init__(self, manager):
+        self.manager = manager
+    def step(self, t=0):
+        self.manager._on_simulation_step()
+        return True
+
 class SimulationManager:
     def __init__(self, sumo_cfg, command_queue: queue.Queue, use_gui=True):
         self.sumo_cfg = sumo_cfg
         self.command_queue = command_queue
         self.use_gui = use_gui
+        self.traci = traci if use_gui or libsumo is None else libsumo
+        self._tls_set_phase = self.traci.trafficlight.setPhase
+        self._lane_results = self.traci.lane.getAllSubscriptionResults
         self.traffic_lights = {}
+        # Edges grouped by direction, so each direction's count is one segment of a reduceat
+        edges_by_direction = {}
+        for edge, direction in EDGE_TO_DIRECTION_MAP.items():
+            edges_by_direction.setdefault(direction, []).append(edge)
+        self._dir_names = tuple(edges_by_direction)
+        self._dir_edges = tuple(e for edges in edges_by_direction.values() for e in edges)
+        self._dir_edge_slots = tuple(enumerate(self._dir_edges))  # (buffer index, edge id), resolved once
+        self._dir_offsets = np.cumsum([0] + [len(e) for e in edges_by_direction.values()])[:-1]
+        # Reused every frame instead of allocating fresh count arrays
+        self._edge_counts = np.zeros(len(self._dir_edges), dtype=np.int32)
+        self._dir_counts = np.zeros(len(self._dir_names), dtype=np.int32)
+        self._phase_map_items = ()  # (tls_id, phase_map) for mapped lights found at discovery
         self.control_mode = "auto"
         self.manual_phase_target = None
         self.manual_phase_changed = False
+        self.broadcast_every = 5  # Steps per published frame; browsers redraw far slower than SUMO steps
+        self._stop_requested = threading.Event()
+
+    def stop(self):
+        """Asks a running simulation to close SUMO and return after its current step."""
+        self._stop_requested.set()
 
     def _process_commands(self):
         try:
@@ -60,48 +140,86 @@ class SimulationManager:
         except queue.Empty:
             pass
 
-    def run(self, data_queue: queue.Queue):
+    def run(self, loop: asyncio.AbstractEventLoop, frames: asyncio.Queue):
+        """Runs on the dedicated simulation thread; every broadcast_every steps a frame is handed to the event loop."""
         sumo_binary = self._get_sumo_binary()
         if not sumo_binary: return
-        traci.start([sumo_binary, "-c", self.sumo_cfg])
+        if SIM_CPUS:
+            # Pinned before start, so a TraCI-launched SUMO process shares the simulation CPU with
+            # the client it runs in lockstep with. With its own CPU the thread can also run at a
+            # higher priority without starving the loop
+            pin_current_thread(SIM_CPUS)
+            try:
+                os.nice(-5)  # On Linux this raises just the calling thread's priority
+            except OSError:
+                pass  # Needs CAP_SYS_NICE
+        self.traci.start([sumo_binary, "-c", self.sumo_cfg])
         self._discover_network_and_phases()
+        listener_id = self.traci.addStepListener(TLSControlListener(self))
         
+        sim_results, sim_step, stop_requested = self.traci.simulation.getSubscriptionResults, self.traci.simulationStep, self._stop_requested.is_set
+        process_commands, gather_data, call_soon = self._process_commands, self._gather_data, loop.call_soon_threadsafe
+        broadcast_every = self.broadcast_every
         step = 0
-        while traci.simulation.getMinExpectedNumber() > 0:
-            self._process_commands()
+        while not stop_requested() and sim_results()[tc.VAR_MIN_EXPECTED_VEHICLES] > 0:
+            process_commands()
 
             if self.control_mode == "manual" and self.manual_phase_changed:
                 for tls_id in self.traffic_lights:
-                    traci.trafficlight.setPhase(tls_id, self.manual_phase_target)
+                    self._set_phase(tls_id, self.manual_phase_target)
                 self.manual_phase_changed = False
             
-            traci.simulationStep()
-            
-            if self.control_mode == "auto":
-                for tls_id in self.traffic_lights:
-                    self._control_traffic_light_state_machine(tls_id, traci.trafficlight.getPhase(tls_id))
-
-            data_queue.put(self._gather_data(step))
+            sim_step()
+            if step % broadcast_every == 0:
+                call_soon(put_latest, frames, gather_data(step))
             step += 1
         
-        traci.close()
-        data_queue.put(None)
+        self.traci.removeStepListener(listener_id)
+        self.traci.close()
+        loop.call_soon_threadsafe(put_latest, frames, None)
+
+    def _on_simulation_step(self):
+        self._subscribe_departed_vehicles()
+        # SUMO's own program may have advanced a phase, so start every step from its view
+        auto = self.control_mode == "auto"
+        for tls_id, res in self.traci.trafficlight.getAllSubscriptionResults().items():
+            phase = self.traffic_lights[tls_id].phase = res[tc.TL_CURRENT_PHASE]
+            if auto:
+                self._control_traffic_light_state_machine(tls_id, phase)
+
+    def _subscribe_departed_vehicles(self):
+        # Subscriptions end automatically when a vehicle leaves the network
+        for vid in self.traci.simulation.getSubscriptionResults()[tc.VAR_DEPARTED_VEHICLES_IDS]:
+            self.traci.vehicle.subscribe(vid, VEHICLE_VARS)
+
+    def _set_phase(self, tls_id, phase_index):
+        # Track the phase we set so frames can report it without asking SUMO
+        self._tls_set_phase(tls_id, phase_index)
+        self.traffic_lights[tls_id].phase = phase_index
 
     def _gather_data(self, step: int) -> Dict[str, Any]:
-        vehicles = [{
-            "id": vid, "x": pos[0], "y": pos[1],
-            "angle": traci.vehicle.getAngle(vid),
-            "speed": traci.vehicle.getSpeed(vid)
-        } for vid, pos in [(v, traci.vehicle.getPosition(v)) for v in traci.vehicle.getIDList()]]
-
-        tls_states = {tls_id: {"state": traci.trafficlight.getRedYellowGreenState(tls_id)} for tls_id in self.traffic_lights}
-        waiting_counts = {direction: traci.edge.getLastStepHaltingNumber(edge) for edge, direction in EDGE_TO_DIRECTION_MAP.items()}
+        # Struct-of-arrays: one float32 array per attribute instead of a dict per vehicle
+        vehicle_results = self.traci.vehicle.getAllSubscriptionResults()
+        results, count = vehicle_results.values(), len(vehicle_results)
+        vehicles = {
+            "ids": list(vehicle_results),
+            "xy": np.fromiter((r[tc.VAR_POSITION] for r in results), dtype=np.dtype((np.float32, 2)), count=count),
+            "angle": np.fromiter((r[tc.VAR_ANGLE] for r in results), dtype=np.float32, count=count),
+            "speed": np.fromiter((r[tc.VAR_SPEED] for r in results), dtype=np.float32, count=count)
+        }
+
+        tls_states = {tls_id: {"state": tls_data.phase_states[tls_data.phase]} for tls_id, tls_data in self.traffic_lights.items()}
+        edge_results = self.traci.edge.getAllSubscriptionResults()
+        edge_counts = self._edge_counts
+        for i, edge in self._dir_edge_slots:
+            edge_counts[i] = edge_results[edge][tc.LAST_STEP_VEHICLE_HALTING_NUMBER]
+        np.add.reduceat(edge_counts, self._dir_offsets, out=self._dir_counts)
+        waiting_counts = dict(zip(self._dir_names, self._dir_counts.tolist()))
         
         green_direction = "Unknown"
-        for tls_id, phase_map in PHASE_MAPS.items():
-            if tls_id in self.traffic_lights:
-                current_phase = traci.trafficlight.getPhase(tls_id)
-                green_direction = phase_map.get(current_phase, f"Yellow (Phase {current_phase})")
+        for tls_id, phase_map in self._phase_map_items:
+            current_phase = self.traffic_lights[tls_id].phase
+            green_direction = phase_map.get(current_phase, f"Yellow (Phase {current_phase})")
 
         return {
             "step": step, "waiting_vehicles": waiting_counts,
@@ -110,64 +228,46 @@ class SimulationManager:
         }
 
     def _discover_network_and_phases(self):
-        all_tls_ids = traci.trafficlight.getIDList()
+        # One subscription per object: subscribing the simulation again would replace this one
+        self.traci.simulation.subscribe([tc.VAR_DEPARTED_VEHICLES_IDS, tc.VAR_MIN_EXPECTED_VEHICLES])
+        for edge in EDGE_TO_DIRECTION_MAP:
+            self.traci.edge.subscribe(edge, [tc.LAST_STEP_VEHICLE_HALTING_NUMBER])
+        all_tls_ids = self.traci.trafficlight.getIDList()
         for tls_id in all_tls_ids:
-            logic = traci.trafficlight.getCompleteRedYellowGreenDefinition(tls_id)[0]
-            phase_to_lanes_map = {}
-            green_phases = []
-            for i, phase in enumerate(logic.phases):
-                state = phase.state.lower()
-                if 'g' in state and 'y' not in state:
-                    green_phases.append(i)
-                    phase_to_lanes_map[i] = set()
-            yellow_phase_map = {}
-            for green_idx in green_phases:
-                next_phase_idx = (green_idx + 1) % len(logic.phases)
-                if 'y' in logic.phases[next_phase_idx].state.lower():
-                    yellow_phase_map[green_idx] = next_phase_idx
-            controlled_links = traci.trafficlight.getControlledLinks(tls_id)
-            for link_idx, links in enumerate(controlled_links):
-                for phase_idx in green_phases:
-                    phase_state = logic.phases[phase_idx].state.lower()
-                    if link_idx < len(phase_state) and phase_state[link_idx] == 'g':
-                        for link in links:
-                            phase_to_lanes_map[phase_idx].add(link[0])
-            self.traffic_lights[tls_id] = {
-                'phase_to_lanes': {p: list(l) for p, l in phase_to_lanes_map.items() if l},
-                'yellow_phase_map': yellow_phase_map, 'timer': 0,
-                'state': 'GREEN', 'target_phase': None
-            }
+            self.traci.trafficlight.subscribe(tls_id, [tc.TL_CURRENT_PHASE])
+            self.traffic_lights[tls_id] = discover_traffic_light(self.traci, tls_id)
+        self._phase_map_items = tuple((tls_id, m) for tls_id, m in PHASE_MAPS.items() if tls_id in self.traffic_lights)
         print("Discovered and mapped traffic light phases.")
 
     def _control_traffic_light_state_machine(self, tls_id, current_phase_index):
         tls_data = self.traffic_lights[tls_id]
-        tls_data['timer'] += 1
-        if tls_data['state'] == 'YELLOW':
-            if tls_data['timer'] >= YELLOW_PHASE_DURATION:
-                traci.trafficlight.setPhase(tls_id, tls_data['target_phase'])
-                tls_data['state'] = 'GREEN'
-                tls_data['timer'] = 0
+        tls_data.timer += 1
+        if tls_data.state == 'YELLOW':
+            if tls_data.timer >= YELLOW_PHASE_DURATION:
+                self._set_phase(tls_id, tls_data.target_phase)
+                tls_data.state = 'GREEN'
+                tls_data.timer = 0
             return
-        if tls_data['state'] == 'GREEN':
-            if tls_data['timer'] < MIN_GREEN_TIME:
+        if tls_data.state == 'GREEN':
+            if tls_data.timer < MIN_GREEN_TIME:
                 return
-            max_pressure = -1
-            best_phase_index = current_phase_index
-            for phase_idx, lanes in tls_data['phase_to_lanes'].items():
-                pressure = sum(traci.lane.getWaitingTime(lane) for lane in lanes)
-                if pressure > max_pressure:
-                    max_pressure = pressure
-                    best_phase_index = phase_idx
+            if not tls_data.phase_ids:
+                return
+            lanes = tls_data.controlled_lanes
+            results = self._lane_results()
+            waits = np.fromiter((results[lane][tc.VAR_WAITING_TIME] for lane in lanes), dtype=np.float64, count=len(lanes))
+            best, max_pressure = argmax_pressure(waits, tls_data.phase_lane_ids, tls_data.phase_offsets)
+            best_phase_index = tls_data.phase_ids[best]
             if best_phase_index != current_phase_index and max_pressure > 0:
-                if current_phase_index in tls_data['yellow_phase_map']:
-                    yellow_phase = tls_data['yellow_phase_map'][current_phase_index]
-                    traci.trafficlight.setPhase(tls_id, yellow_phase)
-                    tls_data['state'] = 'YELLOW'
-                    tls_data['target_phase'] = best_phase_index
-                    tls_data['timer'] = 0
+                if current_phase_index in tls_data.yellow_phase_map:
+                    yellow_phase = tls_data.yellow_phase_map[current_phase_index]
+                    self._set_phase(tls_id, yellow_phase)
+                    tls_data.state = 'YELLOW'
+                    tls_data.target_phase = best_phase_index
+                    tls_data.timer = 0
                 else:
-                    traci.trafficlight.setPhase(tls_id, best_phase_index)
-                    tls_data['timer'] = 0
+                    self._set_phase(tls_id, best_phase_index)
+                    tls_data.timer = 0
 
     def _get_sumo_binary(self):
         if 'SUMO_HOME' in os.environ:
@@ -176,24 +276,43 @@ class SimulationManager:
 
 # --- FASTAPI APP ---
 app = FastAPI()
-data_queue, command_queue = queue.Queue(), queue.Queue()
+command_queue, frame_queue = queue.Queue(), asyncio.Queue(maxsize=FRAME_QUEUE_SIZE)
 app.mount("/static", StaticFiles(directory="static"), name="static")
-network_data = parse_network(NETWORK_FILE)
+network_data = load_network(NETWORK_FILE)
 manager = ConnectionManager()
 
 @app.on_event("startup")
-def startup_event():
-    sim_manager = SimulationManager(SUMO_CONFIG_FILE, command_queue)
-    threading.Thread(target=sim_manager.run, args=(data_queue,), daemon=True).start()
+async def startup_event():
+    app.state.sim_manager = SimulationManager(SUMO_CONFIG_FILE, command_queue)
+    pin_current_thread(LOOP_CPUS)
+    loop = asyncio.get_running_loop()
+    # The step loop blocks inside SUMO, so it gets its own worker: that thread is pinned and
+    # reniced, which must not leak into the default executor's shared pool
+    app.state.sim_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="simulation")
+    loop.run_in_executor(app.state.sim_executor, app.state.sim_manager.run, loop, frame_queue)
     asyncio.create_task(broadcast_data())
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Executor threads are not daemons; without this, exiting waits for the whole simulation
+    app.state.sim_manager.stop()
+    app.state.sim_executor.shutdown(wait=False)
+
 async def broadcast_data():
+    last_step, last_sent, last_key = -1, -1, None
     while True:
         try:
-            data = data_queue.get_nowait()
-            if data is None: await manager.broadcast(json.dumps({"status": "finished"})); break
-            await manager.broadcast(json.dumps(data))
-        except queue.Empty: await asyncio.sleep(0.05)
+            data = await frame_queue.get()
+            # Only the newest snapshot matters for rendering, so skip any backlog
+            while not frame_queue.empty(): data = frame_queue.get_nowait()
+            if data is None: manager.broadcast(FINISHED_FRAME); break
+            if data["step"] <= last_step: continue  # Superseded by a frame already sent
+            last_step = data["step"]
+            # During quiet stretches (e.g. everything stopped at a red) consecutive frames are identical
+            key = frame_key(data)
+            if key == last_key and last_step - last_sent < KEYFRAME_INTERVAL: continue
+            last_sent, last_key = last_step, key
+            manager.broadcast(orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY))
         except Exception: break
 
 @app.get("/")
@@ -208,5 +327,5 @@ async def get_network_data():
 async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
     try:
-        while True: command_queue.put(json.loads(await websocket.receive_text()))
+        while True: command_queue.put(orjson.loads(await websocket.receive_text()))
     except WebSocketDisconnect: manager.disconnect(websocket)
\ No newline at end of file
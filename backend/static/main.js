@@ -22,6 +22,8 @@ document.addEventListener('DOMContentLoaded', async () => {
     
     //  WebSocket Setup 
     const socket = new WebSocket(`ws://${window.location.host}/ws`);
+    socket.binaryType = "arraybuffer";
+    const decoder = new TextDecoder();
 
     function sendCommand(command, value) {
         if (socket.readyState === WebSocket.OPEN) {
@@ -41,7 +43,8 @@ document.addEventListener('DOMContentLoaded', async () => {
     };
 
     socket.onmessage = (event) => {
-        const data = JSON.parse(event.data);
+        // Frames arrive as binary UTF-8 JSON
+        const data = JSON.parse(decoder.decode(event.data));
         if (data.status === "finished") {
             elements.status.textContent = "Simulation Finished";
             return;
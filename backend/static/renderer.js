@@ -47,7 +47,8 @@ const RENDERER = {
         this.ctx.clearRect(0, 0, this.canvas.width, this.canvas.height);
         this.drawIntersection();
         this.drawTrafficLights(data.tlsState);
-        if (data.vehicles) data.vehicles.forEach(v => this.drawVehicle(v));
+        const v = data.vehicles;
+        if (v) v.ids.forEach((id, i) => this.drawVehicle(id, v.xy[i][0], v.xy[i][1], v.angle[i], v.speed[i]));
     },
     drawIntersection() {
         this.networkData.edges.forEach(edge => {
@@ -79,8 +80,7 @@ const RENDERER = {
             }
         });
     },
-    drawVehicle(vehicle) {
-        const { x, y, angle, speed, id } = vehicle;
+    drawVehicle(id, x, y, angle, speed) {
         const pos = this._transform({ x, y });
         const vLength = 4.5 * this.transform.scale;
         const vWidth = 2.0 * this.transform.scale;
@@ -0,0 +1,70 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+import traci.constants as tc
+
+@dataclass(slots=True)
+class TLSState:
+    """Per traffic light topology, current phase and state machine bookkeeping."""
+    phase_ids: List[int]
+    phase_lane_ids: np.ndarray  # Indices into controlled_lanes, grouped by phase
+    phase_offsets: np.ndarray   # Phase p owns phase_lane_ids[phase_offsets[p]:phase_offsets[p + 1]]
+    yellow_phase_map: Dict[int, int]
+    controlled_lanes: List[str]
+    phase_states: List[str]
+    phase: int
+    timer: int = 0
+    state: str = 'GREEN'  # Can be 'GREEN' or 'YELLOW'
+    target_phase: Optional[int] = None
+
+def discover_traffic_light(traci_api, tls_id: str) -> TLSState:
+    """
+    Maps a traffic light's green phases to the lanes they serve and to the yellow phase that
+    follows each of them, and subscribes the controlled lanes to their waiting time.
+    """
+    logic = traci_api.trafficlight.getCompleteRedYellowGreenDefinition(tls_id)[0]
+
+    phase_to_lanes_map = {}
+    green_phases = []
+    for i, phase in enumerate(logic.phases):
+        state = phase.state.lower()
+        if 'g' in state and 'y' not in state:
+            green_phases.append(i)
+            phase_to_lanes_map[i] = set()
+
+    # Find the yellow phase that follows each green phase
+    yellow_phase_map = {}
+    for green_idx in green_phases:
+        # The yellow phase is typically the next one in the sequence
+        next_phase_idx = (green_idx + 1) % len(logic.phases)
+        if 'y' in logic.phases[next_phase_idx].state.lower():
+            yellow_phase_map[green_idx] = next_phase_idx
+
+    controlled_links = traci_api.trafficlight.getControlledLinks(tls_id)
+    # Link i is green in a phase when that phase's state string has a 'g' at i
+    state_codes = [np.frombuffer(phase.state.lower().encode(), dtype=np.uint8) for phase in logic.phases]
+    for phase_idx in green_phases:
+        for link_idx in np.flatnonzero(state_codes[phase_idx] == ord('g')).tolist():
+            if link_idx < len(controlled_links):
+                phase_to_lanes_map[phase_idx].update(link[0] for link in controlled_links[link_idx])
+
+    # Static topology, fetched once instead of on every control step
+    controlled_lanes = list(dict.fromkeys(traci_api.trafficlight.getControlledLanes(tls_id)))
+    phase_to_lanes = {p: list(l) for p, l in phase_to_lanes_map.items() if l}
+
+    # Waiting times come back with every step's reply; the pressure of each green
+    # phase is then a segment sum over indices into controlled_lanes
+    for lane in controlled_lanes:
+        traci_api.lane.subscribe(lane, [tc.VAR_WAITING_TIME])
+    lane_index = {lane: i for i, lane in enumerate(controlled_lanes)}
+
+    return TLSState(
+        phase_ids=list(phase_to_lanes),
+        phase_lane_ids=np.array([lane_index[l] for lanes in phase_to_lanes.values() for l in lanes], dtype=np.int32),
+        phase_offsets=np.cumsum([0] + [len(l) for l in phase_to_lanes.values()]).astype(np.int32),
+        yellow_phase_map=yellow_phase_map,
+        controlled_lanes=controlled_lanes,
+        phase_states=[phase.state for phase in logic.phases],
+        phase=traci_api.trafficlight.getPhase(tls_id)
+    )